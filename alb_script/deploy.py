@@ -2,33 +2,164 @@ import boto3
 import json
 import yaml
 import argparse
+import functools
+import hashlib
+import logging
 import os
-
+import sys
+import tempfile
+import time
+import types
+
+from botocore.config import Config
+from botocore.exceptions import WaiterError
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Mapping
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# error codes returned by aws when describe calls are throttled
+THROTTLING_ERROR_CODES = ["Throttling", "ThrottlingException", "RequestLimitExceeded"]
+
+# longest a throttled waiter backs off between polls, in seconds
+MAX_WAITER_DELAY = 60
+
+# ec2 accepts at most 200 values per filter, so larger lookups are split into chunks
+MAX_FILTER_VALUES = 200
+MAX_LOOKUP_WORKERS = 8
+
+# instance lookups are cached on disk so quickly re-running a failed deploy skips ec2
+CACHE_DIR = os.path.expanduser("~/.cache/alb_script")
+CACHE_TTL_SECONDS = 60
+
+# target group properties shared by every version, read only since they are copied shallowly
+TARGET_GROUP_PROPERTIES = types.MappingProxyType(
+    {
+        "HealthCheckIntervalSeconds": 5,
+        "HealthCheckTimeoutSeconds": 4,
+        "HealthyThresholdCount": 2,
+        "HealthCheckPath": "/healthcheck",
+        "Port": 8000,
+        "Protocol": "HTTP",
+        "ProtocolVersion": "HTTP1",
+    }
+)
 
-def find_instances(region: str, clusters: List[str]):
+log = logging.getLogger(__name__)
+
+_SESSION = boto3.session.Session()
+# adaptive retries rate limit the client side when aws starts throttling, and the connection
+# pool is large enough that every lookup thread keeps its own connection open
+_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+    max_pool_connections=20,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _client(service: str, region: str):
+    """return a client for the given service and region, creating it only once
+
+    Args:
+        service (str): the aws service name, e.g. "ec2"
+        region (str): the aws region
+
+    Returns:
+        client (botocore.client.BaseClient): the cached client
+    """
+    return _SESSION.client(service, region, config=_CONFIG)
+
+
+def _describe_instances(client, tags):
+    """page through describe_instances and bucket the instance ids by cluster id
+
+    Args:
+        client (botocore.client.EC2): the ec2 client
+        tags (List[dict]): the describe_instances filters
+
+    Returns:
+        instance_ids (Mapping[str, List[str]]): map from each cluster id to the ids of its instances
+    """
+    paginator = client.get_paginator("describe_instances")
+    pages = paginator.paginate(Filters=tags, PaginationConfig={"PageSize": 1000})
+    instances = (
+        instance
+        for page in pages
+        for reservation in page["Reservations"]
+        for instance in reservation["Instances"]
+    )
+    instance_ids = {}
+    for instance in instances:
+        for tag in instance.get("Tags", []):
+            if tag["Key"] == "anyscale-session-id":
+                instance_ids.setdefault(tag["Value"], []).append(instance["InstanceId"])
+    return instance_ids
+
+
+def _prune_cache():
+    """remove the cached instance lookups that are past their ttl"""
+    for entry in os.scandir(CACHE_DIR):
+        try:
+            if time.time() - entry.stat().st_mtime >= CACHE_TTL_SECONDS:
+                os.remove(entry.path)
+        except OSError:
+            # another run may have removed or replaced the entry first
+            pass
+
+
+def find_instances(region: str, clusters: List[str], use_cache: bool = True):
     """find all running instances that match any of the cluster ids provided
 
     Args:
         region (str): the aws region
-        clusters (List[str]): _description_
+        clusters (List[str]): the cluster ids to search for
+        use_cache (bool): whether to reuse a lookup of the same clusters from the last minute
 
     Returns:
-        instance_ids (List[str]): list of all instance ids that match any of the cluster ids provided
+        instance_ids (Mapping[str, List[str]]): map from each cluster id to the ids of its instances
     """
-    print(f"Searching for all instances with these cluster ids: {clusters} ...")
-    client = boto3.client("ec2", region)
+    key = hashlib.sha1(json.dumps([region, sorted(clusters)]).encode()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+    if use_cache:
+        try:
+            if time.time() - os.path.getmtime(cache_path) < CACHE_TTL_SECONDS:
+                with open(cache_path, "r") as file:
+                    instance_ids = json.load(file)
+                # anything other than a map is a corrupt entry, so treat it as a miss
+                if isinstance(instance_ids, dict):
+                    log.debug("Using cached instances for these cluster ids: %s.", clusters)
+                    return instance_ids
+        except (OSError, ValueError):
+            pass
+
+    log.debug("Searching for all instances with these cluster ids: %s ...", clusters)
+    client = _client("ec2", region)
     tags = [
         {"Name": "tag:anyscale-session-id", "Values": clusters},
         {"Name": "instance-state-name", "Values": ["running"]},
     ]
-    response = client.describe_instances(Filters=tags)
-    instance_ids = []
-    for reservation in response["Reservations"]:
-        for instance in reservation["Instances"]:
-            instance_ids.append(instance["InstanceId"])
-    print(f"Found {len(instance_ids)} instances with these cluster ids: {clusters}.\n")
+    instance_ids = _describe_instances(client, tags)
+    # the cache only saves a lookup, so failing to write it must not fail the deploy
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _prune_cache()
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(instance_ids, file)
+            # swap the file in whole so a concurrent run never reads a partial write
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+    except OSError as e:
+        log.debug("Could not cache instances for these cluster ids: %s (%s).", clusters, e)
+    count = sum(len(ids) for ids in instance_ids.values())
+    log.debug("Found %d instances with these cluster ids: %s.", count, clusters)
     return instance_ids
 
 
@@ -45,15 +176,19 @@ def parse_input(config_path):
         versions (List[Tuple]): array containing information about each version of the deployed service
         parameters (dict): cloudformation parameters
     """
-    print("Parsing the config yaml ...")
-    inputs = yaml.safe_load(open(config_path, "r"))
+    log.info("Parsing the config yaml ...")
+    # prefer the libyaml backed loader when pyyaml was built with it
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(config_path, "r", encoding="utf-8") as file:
+        inputs = yaml.load(file, Loader=loader)
 
     stack_name = inputs["stack_name"]
     region = inputs["region"]
 
-    versions = []
-    for version in inputs["versions"]:
-        versions.append(version.values())
+    versions = [
+        (version["name"], version["weight"], version["cluster_ids"])
+        for version in inputs["versions"]
+    ]
 
     parameters = [
         {
@@ -66,11 +201,39 @@ def parse_input(config_path):
         },
         {"ParameterKey": "VPCID", "ParameterValue": inputs["vpc_id"]},
     ]
-    print("Finished parsing the config yaml.\n")
+    log.info("Finished parsing the config yaml.\n")
     return region, stack_name, versions, parameters
 
 
-def plan(region, stack_name, versions):
+def build_target_group(stack_name, version, clusters, instances):
+    """generate the target group resource for one version of the service
+
+    Args:
+        stack_name (str): name of the cloudformation stack
+        version (str): name of the version
+        clusters (List[str]): cluster ids serving this version
+        instances (Mapping[str, List[str]]): map from each cluster id to the ids of its instances
+
+    Returns:
+        target_group (dict): the cloudformation target group resource
+    """
+    targets = [
+        {"Id": instance, "Port": 8000}
+        for cluster in clusters
+        for instance in instances.get(cluster, [])
+    ]
+    return {
+        "Type": "AWS::ElasticLoadBalancingV2::TargetGroup",
+        "Properties": {
+            **TARGET_GROUP_PROPERTIES,
+            "Name": f"tg-{version}-{stack_name}",
+            "VpcId": {"Ref": "VPCID"},
+            "Targets": targets,
+        },
+    }
+
+
+def plan(region, stack_name, versions, use_cache=True):
     """generate the cloudformation stack template with the given parameters
 
     Args:
@@ -78,11 +241,12 @@ def plan(region, stack_name, versions):
         stack_name (str): name of the cloudformation stack
         versions: array containing information about each version of the deployed service
                 - each version is defined with the following tuple (version, weight, [cluster_id, ...])
+        use_cache (bool): whether to reuse instance lookups from the last minute
 
     Returns:
         cf_template (str): the generated cloudformation template in json form
     """
-    print("Generating the cloudformation template ...\n")
+    log.info("Generating the cloudformation template ...\n")
     params = {
         "SecurityGroups": {
             "Description": "List of security groups",
@@ -95,67 +259,103 @@ def plan(region, stack_name, versions):
         "VPCID": {"Description": "VPC ID of all of the instances", "Type": "String"},
     }
 
-    resources = {}
-    resources[f"ALB{stack_name}"] = {
-        "Type": "AWS::ElasticLoadBalancingV2::LoadBalancer",
-        "Properties": {
-            "IpAddressType": "ipv4",
-            "Name": f"ALB{stack_name}",
-            "SecurityGroups": {"Ref": "SecurityGroups"},
-            "Subnets": {"Ref": "Subnets"},
-            "Type": "application",
-        },
-    }
+    # look up the instances of every version, in as few requests as the filter limit allows
+    all_clusters = sorted({cluster for _, _, clusters in versions for cluster in clusters})
+    chunks = [
+        all_clusters[i : i + MAX_FILTER_VALUES]
+        for i in range(0, len(all_clusters), MAX_FILTER_VALUES)
+    ]
+    # sessions are not thread safe, so build the shared client before fanning out
+    _client("ec2", region)
+    instances = {}
+    with ThreadPoolExecutor(max_workers=max(min(MAX_LOOKUP_WORKERS, len(chunks)), 1)) as executor:
+        for chunk_instances in executor.map(
+            lambda chunk: find_instances(region, chunk, use_cache), chunks
+        ):
+            instances.update(chunk_instances)
+    count = sum(len(ids) for ids in instances.values())
+    log.info("Found %d instances across %d clusters.\n", count, len(all_clusters))
 
     # generate default routing rule for the ALB dependent on given input weights
-    target_groups = []
-    for version, weight, _ in versions:
-        target_groups.append(
-            {"TargetGroupArn": {"Ref": f"TG{version}{stack_name}"}, "Weight": weight}
-        )
-    resources[f"ALBListener{stack_name}"] = {
-        "Type": "AWS::ElasticLoadBalancingV2::Listener",
-        "Properties": {
-            "LoadBalancerArn": {"Ref": f"ALB{stack_name}"},
-            "Port": 80,
-            "Protocol": "HTTP",
-            "DefaultActions": [
-                {
-                    "Type": "forward",
-                    "ForwardConfig": {"TargetGroups": target_groups},
-                }
-            ],
+    target_groups = [
+        {"TargetGroupArn": {"Ref": f"TG{version}{stack_name}"}, "Weight": weight}
+        for version, weight, _ in versions
+    ]
+    resources = {
+        f"ALB{stack_name}": {
+            "Type": "AWS::ElasticLoadBalancingV2::LoadBalancer",
+            "Properties": {
+                "IpAddressType": "ipv4",
+                "Name": f"ALB{stack_name}",
+                "SecurityGroups": {"Ref": "SecurityGroups"},
+                "Subnets": {"Ref": "Subnets"},
+                "Type": "application",
+            },
         },
-    }
-
-    # generate target groups for each version of the service
-    for version, weight, clusters in versions:
-        targets = []
-        for instance in find_instances(region, clusters):
-            targets.append({"Id": instance, "Port": 8000})
-        resources[f"TG{version}{stack_name}"] = {
-            "Type": "AWS::ElasticLoadBalancingV2::TargetGroup",
+        f"ALBListener{stack_name}": {
+            "Type": "AWS::ElasticLoadBalancingV2::Listener",
             "Properties": {
-                "HealthCheckIntervalSeconds": 5,
-                "HealthCheckTimeoutSeconds": 4,
-                "HealthyThresholdCount": 2,
-                "HealthCheckPath": "/healthcheck",
-                "Name": f"tg-{version}-{stack_name}",
-                "Port": 8000,
+                "LoadBalancerArn": {"Ref": f"ALB{stack_name}"},
+                "Port": 80,
                 "Protocol": "HTTP",
-                "ProtocolVersion": "HTTP1",
-                "VpcId": {"Ref": "VPCID"},
-                "Targets": targets,
+                "DefaultActions": [
+                    {
+                        "Type": "forward",
+                        "ForwardConfig": {"TargetGroups": target_groups},
+                    }
+                ],
             },
-        }
+        },
+        # generate target groups for each version of the service
+        **{
+            f"TG{version}{stack_name}": build_target_group(stack_name, version, clusters, instances)
+            for version, _, clusters in versions
+        },
+    }
 
-    cf_template = {"Parameters": params, "Resources": resources}
-    cf_template_json = json.dumps(cf_template, indent=2)
+    outputs = {"ALBDNSName": {"Value": {"Fn::GetAtt": [f"ALB{stack_name}", "DNSName"]}}}
 
-    with open("cf_template.json", "w") as file:
-        file.write(cf_template_json)
-    print("Generated the cloudformation template. A copy has been saved in cf_template.json.\n")
-    return cf_template_json
+    cf_template = {"Parameters": params, "Resources": resources, "Outputs": outputs}
+    if orjson is not None:
+        with open("cf_template.json", "wb") as file:
+            file.write(orjson.dumps(cf_template, option=orjson.OPT_INDENT_2))
+    else:
+        with open("cf_template.json", "w") as file:
+            json.dump(cf_template, file, indent=2)
+    log.info("Generated the cloudformation template. A copy has been saved in cf_template.json.\n")
+    # the deployed copy is compact to keep the template body well under the inline size limit
+    if orjson is not None:
+        return orjson.dumps(cf_template).decode()
+    return json.dumps(cf_template, separators=(",", ":"))
+
+
+def wait_for_stack(waiter, stack_name, waiter_config):
+    """wait on the given stack, backing off if the waiter is throttled
+
+    Args:
+        waiter (botocore.waiter.Waiter): the cloudformation waiter to wait on
+        stack_name (str): name of the cloudformation stack
+        waiter_config (dict): the initial Delay and MaxAttempts of the waiter
+    """
+    delay = waiter_config["Delay"]
+    deadline = time.monotonic() + delay * waiter_config["MaxAttempts"]
+    while True:
+        # spend only the attempts that still fit before the original timeout
+        max_attempts = max(int((deadline - time.monotonic()) // delay), 1)
+        try:
+            waiter.wait(
+                StackName=stack_name,
+                WaiterConfig={"Delay": delay, "MaxAttempts": max_attempts},
+            )
+            return
+        except WaiterError as e:
+            error_code = (e.last_response or {}).get("Error", {}).get("Code")
+            if error_code not in THROTTLING_ERROR_CODES or time.monotonic() + delay >= deadline:
+                raise
+            # the waiter gives up on an error without sleeping, so back off before retrying
+            log.warning("Throttled while waiting on the stack, retrying in %ds ...", delay)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_WAITER_DELAY)
 
 
 def apply(region, stack_name, cf_template, parameters):
@@ -167,38 +367,39 @@ def apply(region, stack_name, cf_template, parameters):
         cf_template (str): the generated cloudformation template in json form
         parameters (dict): cloudformation parameters
     """
-    print("Applying the cloudformation template ...\n")
-    client = boto3.client("cloudformation", region)
+    log.info("Applying the cloudformation template ...\n")
+    client = _client("cloudformation", region)
     try:
-        client.create_stack(StackName=stack_name, TemplateBody=cf_template, Parameters=parameters)
+        response = client.create_stack(
+            StackName=stack_name, TemplateBody=cf_template, Parameters=parameters
+        )
         waiter = client.get_waiter("stack_create_complete")
-        waiter_config = {}
+        waiter_config = {"Delay": 3, "MaxAttempts": 1200}
     except client.exceptions.AlreadyExistsException:
-        client.update_stack(
+        response = client.update_stack(
             StackName=stack_name,
             TemplateBody=cf_template,
             Parameters=parameters,
         )
         waiter = client.get_waiter("stack_update_complete")
-        waiter_config = {"Delay": 2}
+        waiter_config = {"Delay": 2, "MaxAttempts": 1800}
 
-    stack_description = client.describe_stacks(StackName=stack_name)
-    stack_id = stack_description["Stacks"][0]["StackId"]
+    stack_id = response["StackId"]
     stack_url = f"https://{region}.console.aws.amazon.com/cloudformation/home?region={region}#stacks/stackinfo?stackId={stack_id}"
-    print(f"View your stack at {stack_url}.\n")
-
-    waiter.wait(StackName=stack_name, WaiterConfig=waiter_config)
-    print("Finished deploying the cloudformation template.\n")
-    alb_description = client.describe_stack_resource(
-        StackName=stack_name, LogicalResourceId=f"ALB{stack_name}"
+    log.info("View your stack at %s.\n", stack_url)
+
+    wait_for_stack(waiter, stack_name, waiter_config)
+    log.info("Finished deploying the cloudformation template.\n")
+    stack_description = client.describe_stacks(StackName=stack_id)
+    outputs = stack_description["Stacks"][0].get("Outputs", [])
+    ALB_dns_name = next(
+        (output["OutputValue"] for output in outputs if output["OutputKey"] == "ALBDNSName"),
+        None,
     )
-    client = boto3.client("elbv2", "us-west-2")
-    response = client.describe_load_balancers(
-        LoadBalancerArns=[alb_description["StackResourceDetail"]["PhysicalResourceId"]]
-    )
-
-    ALB_dns_name = response["LoadBalancers"][0]["DNSName"]
-    print(f"The DNS name of your ALB is {ALB_dns_name}.")
+    if ALB_dns_name is None:
+        log.warning("The stack has no ALBDNSName output, find the DNS name of your ALB in the console.")
+        return
+    log.info("The DNS name of your ALB is %s.", ALB_dns_name)
 
 
 def delete(region, stack_name):
@@ -208,13 +409,13 @@ def delete(region, stack_name):
         region (str): the aws region
         stack_name (str): name of the cloudformation stack
     """
-    print(f"Deleting cloudformation stack {stack_name} ...")
-    client = boto3.client("cloudformation", region)
+    log.info("Deleting cloudformation stack %s ...", stack_name)
+    client = _client("cloudformation", region)
     client.delete_stack(StackName=stack_name)
 
     waiter = client.get_waiter("stack_delete_complete")
     waiter.wait(StackName=stack_name, WaiterConfig={"Delay": 1})
-    print(f"Deleted cloudformation stack {stack_name}.")
+    log.info("Deleted cloudformation stack %s.", stack_name)
 
 
 parser = argparse.ArgumentParser(description="Apply the input yaml to a cloudformation stack")
@@ -225,23 +426,34 @@ parser.add_argument(
     type=os.path.abspath,
     help="The relative path to the config yaml",
 )
+parser.add_argument(
+    "--no-cache",
+    dest="use_cache",
+    action="store_false",
+    help="Always look up the instances in ec2 instead of reusing a lookup from the last minute",
+)
 
 if __name__ == "__main__":
+    # only this script's progress goes to stdout, third party loggers keep their defaults
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
     args = parser.parse_args()
     verb = args.verb
     config_path = args.path
 
     if verb not in ["apply", "delete"]:
-        print(f"{verb} is not a valid verb. Please use either 'apply' or 'delete'.")
+        log.error("%s is not a valid verb. Please use either 'apply' or 'delete'.", verb)
         quit()
 
     if not os.path.exists(config_path):
-        print(f"The path specified ({config_path}) does not exist")
+        log.error("The path specified (%s) does not exist", config_path)
         quit()
     region, stack_name, versions, parameters = parse_input(config_path)
 
     if verb == "apply":
-        template = plan(region, stack_name, versions)
+        template = plan(region, stack_name, versions, args.use_cache)
         apply(region, stack_name, template, parameters)
     elif verb == "delete":
         delete(region, stack_name)